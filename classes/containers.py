@@ -0,0 +1,142 @@
+from collections import Counter, OrderedDict
+import lxml.etree as ET
+import re
+
+box_pattern = re.compile(r'^(box)?(\d+).(\d+)$')
+
+
+class ContainerTable(object):
+
+    '''Column-oriented table of the container elements in an EAD'''
+
+    columns = {'types': 'type', 'ids': 'id', 'parents': 'parent'}
+
+    def __init__(self, root):
+        self.elems = root.xpath('//container')
+        self.dids = [c.getparent() for c in self.elems]
+        self.levels = [d.getparent().get('level') if d.getparent() is not None
+                       else None for d in self.dids]
+        self.types = [c.get('type') for c in self.elems]
+        self.ids = [c.get('id') for c in self.elems]
+        self.parents = [c.get('parent') for c in self.elems]
+        self.texts = [c.text for c in self.elems]
+        self.added = [False] * len(self.elems)
+        self.dirty = set()
+
+
+    def __len__(self):
+        return len(self.elems)
+
+
+    #========================================================
+    # Parse a box identifier into its (prefix, number) parts
+    #========================================================
+    @staticmethod
+    def parse_box(value):
+        match = box_pattern.search(value or '')
+        if match:
+            return match.group(2), match.group(3)
+        return None
+
+
+    #==========================================
+    # Rows of the table grouped by did element
+    #==========================================
+    def groups(self):
+        result = OrderedDict()
+        for row, did in enumerate(self.dids):
+            if did is not None and did.tag == 'did':
+                result.setdefault(did, []).append(row)
+        return result
+
+
+    #===============================================
+    # Update a cell, to be written back to the tree
+    #===============================================
+    def set(self, row, column, value):
+        getattr(self, column)[row] = value
+        self.dirty.add(row)
+
+
+    #================================================
+    # Create a new container as the last child of did
+    #================================================
+    def append(self, did, type, id, text):
+        elem = ET.SubElement(did, "container")
+        elem.set('type', type)
+        elem.set('id', id)
+        elem.text = text
+        self.elems.append(elem)
+        self.dids.append(did)
+        self.levels.append(did.getparent().get('level'))
+        self.types.append(type)
+        self.ids.append(id)
+        self.parents.append(None)
+        self.texts.append(text)
+        self.added.append(True)
+        return len(self.elems) - 1
+
+
+    #===================================================
+    # Drop rows for containers no longer under the root
+    #===================================================
+    def prune(self, root):
+        self.write()
+        attached = {}
+        keep = []
+        for row, parent in enumerate(self.dids):
+            if parent not in attached:
+                attached[parent] = parent is root or any(
+                    a is root for a in parent.iterancestors())
+            if attached[parent]:
+                keep.append(row)
+        if len(keep) == len(self.elems):
+            return
+        for column in ('elems', 'dids', 'levels', 'types', 'ids',
+                       'parents', 'texts', 'added'):
+            values = getattr(self, column)
+            setattr(self, column, [values[row] for row in keep])
+
+
+    #================================================
+    # Write changed cells back to the container nodes
+    #================================================
+    def write(self):
+        for row in sorted(self.dirty):
+            elem = self.elems[row]
+            for column, attribute in self.columns.items():
+                value = getattr(self, column)[row]
+                if value is None:
+                    elem.attrib.pop(attribute, None)
+                else:
+                    elem.set(attribute, value)
+            elem.text = self.texts[row]
+        self.dirty.clear()
+
+
+    #=============================================
+    # Report missing box numbers in the sequence
+    #=============================================
+    def box_gaps(self):
+        # box numbers as written to the text, grouped by their id prefix
+        numbers = {}
+        for type, id in zip(self.types, self.ids):
+            parts = self.parse_box(id) if type == 'box' else None
+            if parts:
+                numbers.setdefault(parts[0], set()).add(int(parts[1]))
+        result = []
+        for prefix in sorted(numbers, key=int):
+            boxes = numbers[prefix]
+            result.extend('{0}.{1}'.format(prefix, n) for n in range(
+                min(boxes), max(boxes)) if n not in boxes)
+        return result
+
+
+    #===========================================================
+    # Report ids used more than once, ignoring the boxes added by
+    # add_missing_box_containers for each of their folders
+    #===========================================================
+    def duplicate_ids(self):
+        counts = Counter(id for id, added in zip(self.ids, self.added)
+                         if id and not added)
+        return sorted(id for id, count in counts.items() if count > 1)
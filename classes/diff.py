@@ -0,0 +1,187 @@
+from collections import Counter, deque
+import lxml.etree as ET
+
+
+class TreeDiff(object):
+
+    '''Element-level changes between an input and a transformed EAD tree'''
+
+    def __init__(self, old_root, new_root):
+        self.old_root = old_root
+        self.new_root = new_root
+        self.old_tree = old_root.getroottree()
+        self.new_tree = new_root.getroottree()
+        self.old_ids = {}
+        for elem in old_root.iter(tag=ET.Element):
+            id = elem.get('id')
+            if id and id not in self.old_ids:
+                self.old_ids[id] = elem
+        self.new_ids = set(e.get('id') for e in new_root.iter(
+            tag=ET.Element) if e.get('id'))
+        self.partners = {}
+        self.changes = []
+        self.compare()
+
+
+    #==========================================================
+    # Walk both trees in step, aligning children at each level
+    #==========================================================
+    def compare(self):
+        self.partners[self.old_root] = self.new_root
+        stack = [(self.old_root, self.new_root)]
+        while stack:
+            old, new = stack.pop()
+            self.compare_nodes(old, new)
+            stack.extend(self.align_children(old, new))
+
+
+    #=================================================
+    # Record attribute and text changes between a pair
+    #=================================================
+    def compare_nodes(self, old, new):
+        if old.tag != new.tag:
+            self.record('renamed', new, old=old.tag, new=new.tag)
+        for name in sorted(set(old.attrib) | set(new.attrib)):
+            old_value = old.get(name)
+            new_value = new.get(name)
+            if old_value != new_value:
+                self.record('attribute', new, name=name,
+                            old=old_value, new=new_value)
+        old_text = (old.text or '').strip()
+        new_text = (new.text or '').strip()
+        if old_text != new_text:
+            self.record('text', new, old=old_text, new=new_text)
+
+
+    #===========================================================
+    # Pair the children of two nodes by id, content and position
+    #===========================================================
+    def align_children(self, old, new):
+        old_children = list(old.iterchildren(tag=ET.Element))
+        new_children = list(new.iterchildren(tag=ET.Element))
+        pairs = []
+        known = []
+        unmatched = []
+
+        # elements with an id are paired wherever they are in the tree
+        for child in new_children:
+            counterpart = self.old_ids.get(child.get('id'))
+            if counterpart is None:
+                unmatched.append(child)
+            elif counterpart not in self.partners:
+                self.pair(counterpart, child)
+                pairs.append((counterpart, child))
+            elif self.partners[counterpart] is child:
+                # already paired and queued for comparison elsewhere
+                known.append((counterpart, child))
+            else:
+                unmatched.append(child)
+
+        # old children whose id survives elsewhere are left for that pairing
+        remaining = [c for c in old_children if c not in self.partners and not
+                     (c.get('id') in self.new_ids and
+                      self.old_ids.get(c.get('id')) is c)]
+
+        # then pair siblings by content, by attribute names and by position
+        for key in (self.signature, self.shape, self.tag):
+            candidates = {}
+            for child in remaining:
+                if child not in self.partners:
+                    candidates.setdefault(key(child), deque()).append(child)
+            leftover = []
+            for child in unmatched:
+                matches = candidates.get(key(child))
+                if matches:
+                    counterpart = matches.popleft()
+                    self.partners[counterpart] = child
+                    pairs.append((counterpart, child))
+                else:
+                    leftover.append(child)
+            unmatched = leftover
+        nested = []
+        for child in unmatched:
+            nested.extend(self.record_added(child))
+        for child in remaining:
+            if child not in self.partners:
+                self.record('removed', child, tree=self.old_tree)
+
+        # flag parents whose surviving children changed order
+        old_positions = {c: n for n, c in enumerate(old_children)}
+        new_positions = {c: n for n, c in enumerate(new_children)}
+        old_order = [old_positions[o] for o, c in sorted(
+            pairs + known, key=lambda p: new_positions[p[1]])
+            if o in old_positions]
+        if old_order != sorted(old_order):
+            self.record('reordered', new)
+
+        return pairs + nested
+
+
+    #==============================================================
+    # Record an added subtree and return the topmost elements moved
+    # into it by id, to be compared with their old counterparts
+    #==============================================================
+    def record_added(self, elem):
+        self.record('added', elem)
+        pairs = []
+        stack = list(elem.iterchildren(tag=ET.Element))
+        while stack:
+            child = stack.pop()
+            counterpart = self.old_ids.get(child.get('id'))
+            if counterpart is not None and counterpart not in self.partners:
+                self.pair(counterpart, child)
+                pairs.append((counterpart, child))
+            else:
+                stack.extend(child.iterchildren(tag=ET.Element))
+        return pairs
+
+
+    #===========================================================
+    # Pair elements by id, noting a move unless the parents are
+    # themselves paired
+    #===========================================================
+    def pair(self, old, new):
+        self.partners[old] = new
+        old_parent = old.getparent()
+        if old_parent is None or \
+                self.partners.get(old_parent) is not new.getparent():
+            self.record('moved', new, old=self.old_tree.getpath(old))
+
+
+    #=====================================================
+    # Content key used to pair identical sibling elements
+    #=====================================================
+    @staticmethod
+    def signature(elem):
+        return (elem.tag, (elem.text or '').strip(),
+                tuple(sorted(elem.attrib.items())))
+
+
+    #===================================================
+    # Looser keys used to pair siblings that have changed
+    #===================================================
+    @staticmethod
+    def shape(elem):
+        return (elem.tag, tuple(sorted(elem.attrib.keys())))
+
+    @staticmethod
+    def tag(elem):
+        return elem.tag
+
+
+    #=================================================
+    # Append a compact change record for one element
+    #=================================================
+    def record(self, change, elem, tree=None, **details):
+        tree = tree if tree is not None else self.new_tree
+        entry = {'change': change, 'tag': elem.tag,
+                 'path': tree.getpath(elem)}
+        entry.update(details)
+        self.changes.append(entry)
+
+
+    #==================================================
+    # Count changes by type and element for rollups
+    #==================================================
+    def summary(self):
+        return Counter((c['change'], c['tag']) for c in self.changes)
@@ -1,8 +1,9 @@
 import logging
 import lxml.etree as ET
-import re
 import string
 
+from classes.containers import ContainerTable
+
 class Ead(object):
 
     '''Encoded Archival Description object'''
@@ -13,19 +14,33 @@ class Ead(object):
         self.tree = ET.parse(xmlfile, parser)
         self.handle = handle
         self.root = self.tree.getroot()
+        self.containers = ContainerTable(self.root)
         self.logger = logging.getLogger("transform.transform")
         self.logger.info('********** Transforming {0} **********'.format(
             self.name
             ).upper()) 
 
 
+    #=====================================
+    # Measure the depth of the element tree
+    #=====================================
+    def depth(self):
+        result = 0
+        stack = [(self.root, 1)]
+        while stack:
+            elem, depth = stack.pop()
+            result = max(result, depth)
+            stack.extend((child, depth + 1) for child in elem)
+        return result
+
+
     #=============================
     # Add title attribute to dao
     #=============================
     def add_title_to_dao(self):
         for dao in self.tree.findall('.//dao'):
             parent = dao.getparent()
-            unittitle = parent.find('unittitle').text
+            unittitle = parent.findtext('unittitle')
             if unittitle:
                 dao.set('title', unittitle)
                 self.logger.info(
@@ -51,67 +66,62 @@ class Ead(object):
     # Add box containers where absent
     #=================================
     def add_missing_box_containers(self):
+        table = self.containers
+        
         # iterate over item- and file-level containers
-        for n, did in enumerate(self.tree.iter('did')):
-            parent = did.getparent()
-            parent_level = parent.get('level')
-
-            if parent_level in ['file', 'item']:
-                # iterate over all the container nodes
-                for c in did.iterchildren(tag='container'):
+        for did, rows in table.groups().items():
+            if table.levels[rows[0]] not in ['file', 'item']:
+                continue
+            
+            for row in rows:
+                # remove "box" from the id attribute
+                old_id = table.ids[row]
+                if old_id:
+                    table.set(row, 'ids', old_id.lstrip('box'))
+                    self.logger.info(
+                        '{0} : Removed "box" prefix from id {1}'.format(
+                            self.name, old_id 
+                            ))
                 
-                    # remove "box" from the id attribute
-                    if c.get('id'):
-                        old_id = c.get('id')
-                        c.set('id', old_id.lstrip('box'))
-                        self.logger.info(
-                            '{0} : Removed "box" prefix from id {1}'.format(
-                                self.name, old_id 
-                                ))
-                    
-                    # remove "box" from the parent attribute
-                    if c.get('parent'):
-                        old_parent = c.get('parent')
-                        c.set('parent', old_parent.lstrip('box'))
-                        self.logger.info(
-                            '{0} : Removed "box" prefix from parent {1}'.format(
-                                self.name, old_parent
-                                ))
-                    
-                    # check whether box container exists; & if so, break out            
-                    if c.get('type') == 'box':
-                        break
-                    
-                    # if not, create a box container
-                    else:
-                        box_attribute = c.get('parent') or ''
-                        match = re.search(r'^(box)?(\d+).(\d+)$', box_attribute)
-                        
-                        # create attributes corresponding to the parent box
-                        if match:
-                            box_number = match.group(2)
-                            box_id = "{0}.{1}".format(match.group(2),
-                                                      match.group(3)
-                                                      )
-                            new_container = ET.SubElement(did, "container")
-                            new_container.set('type', 'box')
-                            new_container.set('id', box_id)
-                            new_container.text = box_number
-                            self.logger.info(
-                                '{0} : Added box {1} to did "{2}"'.format(
-                                    self.name, box_id, box_attribute
-                                    ))
+                # remove "box" from the parent attribute
+                old_parent = table.parents[row]
+                if old_parent:
+                    table.set(row, 'parents', old_parent.lstrip('box'))
+                    self.logger.info(
+                        '{0} : Removed "box" prefix from parent {1}'.format(
+                            self.name, old_parent
+                            ))
+                
+                # check whether box container exists; & if so, break out
+                if table.types[row] == 'box':
+                    break
+                
+                # if not, create a box container for the parent box
+                box_attribute = table.parents[row] or ''
+                parts = table.parse_box(box_attribute)
+                if parts:
+                    box_id = "{0}.{1}".format(*parts)
+                    table.append(did, 'box', box_id, parts[0])
+                    self.logger.info(
+                        '{0} : Added box {1} to did "{2}"'.format(
+                            self.name, box_id, box_attribute
+                            ))
+        
+        table.write()
 
 
     #================================
     # Sort containers hierarchically
     #================================
     def sort_containers(self):
-        # iterate over item- and file-level containers
-        for n, did in enumerate(self.tree.iter('did')):
-            for elem in list(did):
-                if 'parent' in elem.keys():
-                    did.append(elem)
+        table = self.containers
+        table.prune(self.root)
+        
+        # move child containers after their parent boxes
+        for did, rows in table.groups().items():
+            for row in rows:
+                if table.parents[row] is not None:
+                    did.append(table.elems[row])
                     self.logger.info(
                     '{0} : Moving child container to last position'.format(
                         self.name
@@ -176,31 +186,58 @@ class Ead(object):
     # fix incorrect box numbers
     #===========================
     def fix_box_number_discrepancies(self):
-        # find all the box-level containers
-        boxes = [c for c in self.tree.iter(
-                    'container') if c.get('type') == 'box'
-                    ]
-        # iterate over these containers
-        for box in boxes:
+        table = self.containers
+        
+        # iterate over the box-level containers
+        for row, type in enumerate(table.types):
+            if type != 'box':
+                continue
+            
             # remove the "box" prefix from the ID
-            current_id = box.get('id')
+            current_id = table.ids[row] or ''
             new_id = current_id.lstrip('box')
             if current_id != new_id:
-                box.set('id', new_id)
+                table.set(row, 'ids', new_id)
                 self.logger.info(
                     '{0} : Changed box "{1}" to "{2}"'.format(
                         self.name, current_id, new_id
                         ))
-            # make the text of element match the id attribute        
-            match = re.search(r'^(box)?(\d+).(\d+)$', box.get('id'))
-            current_text = box.text
-            new_text = match.group(3)
+            
+            # make the text of element match the id attribute
+            parts = table.parse_box(new_id)
+            if not parts:
+                self.logger.warn(
+                    '{0} : Cannot parse box id "{1}"'.format(
+                        self.name, new_id
+                        ))
+                continue
+            current_text = table.texts[row]
+            new_text = parts[1]
             if current_text != new_text:
-                box.text = new_text
+                table.set(row, 'texts', new_text)
                 self.logger.info(
                     '{0} : Corrected box {1} to {2}'.format(
-                        self.name, current_text, box.text
+                        self.name, current_text, new_text
                         ))
+        
+        table.write()
+
+
+    #======================================
+    # Report box-number gaps and duplicates
+    #======================================
+    def report_containers(self):
+        self.containers.prune(self.root)
+        gaps = self.containers.box_gaps()
+        if gaps:
+            self.logger.warn('{0} : Missing box numbers {1}'.format(
+                self.name, ', '.join(str(n) for n in gaps)
+                ))
+        duplicates = self.containers.duplicate_ids()
+        if duplicates:
+            self.logger.warn('{0} : Duplicate container ids {1}'.format(
+                self.name, ', '.join(duplicates)
+                ))
 
 
     #==================================================
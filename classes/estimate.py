@@ -0,0 +1,171 @@
+from collections import Counter
+import math
+import os
+import random
+
+
+class Estimate(object):
+
+    '''Stratified random sample of files used to extrapolate a full run'''
+
+    def __init__(self, files, sample_size, seed=None):
+        self.sizes = {f: os.path.getsize(f) for f in files}
+        self.strata = self.stratify(files, sample_size)
+        self.random = random.Random(seed)
+        self.sample = self.draw(sample_size)
+        self.results = {}
+
+
+    #=============================================================
+    # Bucket a file by its directory and order of magnitude in size
+    #=============================================================
+    def stratum(self, f, by_directory=True):
+        size = self.sizes[f]
+        bucket = int(math.log(size, 4)) if size > 0 else 0
+        return os.path.dirname(f) if by_directory else '', bucket
+
+
+    #=================================================================
+    # Group files into strata, collapsing directories and then sizes
+    # until there are no more strata than files to sample
+    #=================================================================
+    def stratify(self, files, sample_size):
+        for by_directory in (True, False):
+            strata = {}
+            for f in files:
+                strata.setdefault(
+                    self.stratum(f, by_directory), []).append(f)
+            if len(strata) <= sample_size:
+                return strata
+        return {('', 0): list(files)} if files else {}
+
+
+    #==============================================================
+    # Allocate the sample proportionally, at least one per stratum,
+    # handing out the rounding remainders largest first
+    #==============================================================
+    def draw(self, sample_size):
+        total = len(self.sizes)
+        spare = max(0, sample_size - len(self.strata))
+        shares = {key: spare * len(members) / total
+                  for key, members in self.strata.items()}
+        counts = {key: 1 + int(share) for key, share in shares.items()}
+        remainders = sorted(shares, key=lambda k: shares[k] - int(shares[k]),
+                            reverse=True)
+        for key in remainders[:sample_size - sum(counts.values())]:
+            counts[key] += 1
+
+        result = {}
+        for key, members in self.strata.items():
+            n = min(len(members), counts[key])
+            result[key] = self.random.sample(members, n)
+        return result
+
+
+    #==================================
+    # List all of the sampled files
+    #==================================
+    def files(self):
+        return [f for members in self.sample.values() for f in members]
+
+
+    #=========================================
+    # Record the measurements for one file
+    #=========================================
+    def add(self, f, measurement):
+        self.results[f] = measurement
+
+
+    #=====================================================================
+    # Stratified estimate of a corpus total, with 95% confidence interval;
+    # strata with a single sampled file use the variance pooled from the
+    # others, and there is no interval (None) if none can be pooled
+    #=====================================================================
+    def total(self, value):
+        estimate = 0.0
+        strata = []
+        for key, members in self.strata.items():
+            values = [value(self.results[f]) for f in self.sample[key]
+                      if f in self.results]
+            if not values:
+                continue
+            n = len(values)
+            mean = sum(values) / n
+            estimate += len(members) * mean
+            s2 = sum((v - mean) ** 2 for v in values) / (n - 1) \
+                if n > 1 else None
+            strata.append((len(members), n, s2))
+
+        pooled = [(n - 1, s2) for N, n, s2 in strata if s2 is not None]
+        df = sum(d for d, s2 in pooled)
+        if not df:
+            return estimate, None
+        pooled_s2 = sum(d * s2 for d, s2 in pooled) / df
+
+        variance = 0.0
+        for N, n, s2 in strata:
+            s2 = pooled_s2 if s2 is None else s2
+            variance += N * N * (1 - n / N) * s2 / n
+        return estimate, 1.96 * math.sqrt(variance)
+
+
+    #===============================================================
+    # Extrapolate the peak RSS to the largest file in the whole set
+    #===============================================================
+    def peak_memory(self):
+        measured = [m for m in self.results.values() if not m['failed']]
+        if not measured:
+            return 0, 0
+        largest = max(measured, key=lambda m: m['bytes'])
+        observed = max(m['baseline'] + m['rss'] for m in measured)
+        scale = max(self.sizes.values()) / max(largest['bytes'], 1)
+        predicted = largest['baseline'] + largest['rss'] * scale
+        return observed, max(observed, predicted)
+
+
+    #=========================================
+    # Format an estimate and its interval
+    #=========================================
+    @staticmethod
+    def interval(estimate, error, fmt='{0:.0f}'):
+        if error is None:
+            return (fmt + ' (no interval)').format(estimate)
+        return (fmt + ' (+/- ' + fmt.replace('0:', '1:') + ')').format(
+            estimate, error)
+
+
+    #====================================
+    # Summarize the estimate for display
+    #====================================
+    def report(self, fixes, jobs=1):
+        lines = ['Sampled {0} of {1} files in {2} strata'.format(
+            len(self.results), len(self.sizes), len(self.strata))]
+
+        # per-file times are summed as CPU time, then spread over workers
+        seconds, error = self.total(lambda m: m['seconds'])
+        lines.append('  CPU time: {0} s'.format(
+            self.interval(seconds, error, '{0:.1f}')))
+        workers = max(1, min(jobs, len(self.sizes)))
+        lines.append('  Wall-clock with {0} workers: {1} s'.format(
+            workers, self.interval(seconds / workers, 
+                                   error and error / workers, '{0:.1f}')))
+
+        observed, predicted = self.peak_memory()
+        lines.append('  Peak memory: {0:.1f} MB (sample max {1:.1f} MB)'.format(
+            predicted / 1024, observed / 1024))
+
+        failed, error = self.total(lambda m: int(m['failed']))
+        lines.append('  Failed files: {0}'.format(
+            self.interval(failed, error)))
+        reasons = Counter(m['reason'] for m in self.results.values()
+                          if m['failed'])
+        for reason, count in reasons.most_common():
+            lines.append('    {0} ({1} sampled)'.format(reason, count))
+
+        lines.append('  Files changed by each fix:')
+        for fix in fixes:
+            changed, error = self.total(lambda m: m['changed'].get(fix, 0))
+            lines.append('    {0}: {1}'.format(
+                fix, self.interval(changed, error)))
+
+        return lines
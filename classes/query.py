@@ -0,0 +1,111 @@
+import lxml.etree as ET
+import re
+
+
+class Query(object):
+
+    '''Set of compiled XPath expressions to be evaluated against EAD files'''
+
+    def __init__(self, expressions):
+        self.expressions = expressions
+        self.xpaths = [ET.XPath(e) for e in expressions]
+        self.required = [self.required_tag(e) for e in expressions]
+
+
+    #===============================================================
+    # Find the element name that must be present for a path to match
+    #===============================================================
+    @staticmethod
+    def required_tag(expression):
+        # only a bare absolute location path (e.g. "//dao[...]/@id") is
+        # certain to be empty without the element; operators, unions and
+        # function calls at the top level may match documents without it
+        if not re.match(r'^/[/\w.:*@-]*$', Query.top_level(expression)):
+            return None
+        # the first step must be a literal element name, not an axis
+        # ("child::ead"), a node test ("text()") or a prefixed name
+        match = re.match(r'^\s*//?([A-Za-z_][\w.-]*)\s*([/\[]|$)', expression)
+        if match:
+            return '<{0}'.format(match.group(1)).encode('ascii')
+        return None
+
+
+    #======================================================
+    # Strip predicates, arguments and strings from a path
+    #======================================================
+    @staticmethod
+    def top_level(expression):
+        result = []
+        depth = 0
+        quote = None
+        for char in expression:
+            if quote:
+                if char == quote:
+                    quote = None
+            elif char in '\'"':
+                quote = char
+                if depth == 0:
+                    result.append(char)
+            elif char in '[(':
+                depth += 1
+            elif char in '])':
+                depth -= 1
+            elif depth == 0:
+                result.append(char)
+        return ''.join(result).strip()
+
+
+    #==========================================================
+    # Return indexes of the expressions that could match bytes
+    #==========================================================
+    def candidates(self, raw_bytes):
+        return [n for n, tag in enumerate(self.required)
+                if tag is None or tag in raw_bytes]
+
+
+    #==============================================
+    # Evaluate the expressions against a parsed tree
+    #==============================================
+    def evaluate(self, filename, tree, indexes=None):
+        if indexes is None:
+            indexes = range(len(self.xpaths))
+        for n in indexes:
+            result = self.xpaths[n](tree)
+            if not isinstance(result, list):
+                # skip empty scalar results, such as zero counts and false
+                if not result or result != result:
+                    continue
+                result = [result]
+            for item in result:
+                yield self.describe(filename, tree, self.expressions[n], item)
+
+
+    #================================================
+    # Summarize a single XPath result as a dictionary
+    #================================================
+    @staticmethod
+    def describe(filename, tree, expression, item):
+        match = {'file': filename, 'query': expression,
+                 'line': None, 'path': None, 'text': None}
+
+        if isinstance(item, ET._Element):
+            match['line'] = item.sourceline
+            match['path'] = tree.getpath(item)
+            match['text'] = item.text.strip() if item.text else ''
+
+        elif isinstance(item, ET._ElementUnicodeResult):
+            parent = item.getparent()
+            if parent is not None:
+                match['line'] = parent.sourceline
+                if item.is_attribute:
+                    suffix = '/@{0}'.format(item.attrname)
+                else:
+                    suffix = '/text()'
+                match['path'] = tree.getpath(parent) + suffix
+            match['text'] = str(item)
+
+        else:
+            # numbers, booleans and bare strings returned by XPath functions
+            match['text'] = item
+
+        return match
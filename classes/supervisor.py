@@ -0,0 +1,168 @@
+from collections import deque
+import multiprocessing
+from multiprocessing.connection import wait
+import os
+import resource
+import time
+
+
+#=============================================
+# Worker loop: run tasks until told to stop
+#=============================================
+def work(conn, target, max_memory=None):
+    # hard cap on the memory the worker may add on top of what it has
+    # at start, so a runaway allocation raises MemoryError between polls
+    if max_memory:
+        limit = virtual_size(os.getpid()) + max_memory
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        try:
+            conn.send((None, target(*task)))
+        except Exception as e:
+            reason = type(e).__name__
+            if str(e):
+                reason = '{0}: {1}'.format(reason, e)
+            conn.send((reason, None))
+
+
+#======================================================
+# Virtual memory size of a process, where /proc exists
+#======================================================
+def virtual_size(pid):
+    try:
+        with open('/proc/{0}/statm'.format(pid)) as statm:
+            pages = int(statm.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class Worker(object):
+
+    '''Worker process with its own pipe and current task'''
+
+    def __init__(self, target, max_memory=None):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=work, args=(child_conn, target, max_memory), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.task = None
+        self.started = None
+
+    def assign(self, task):
+        self.task = task
+        self.started = time.monotonic()
+        self.conn.send(task)
+
+    def finish(self):
+        task = self.task
+        self.task = None
+        self.started = None
+        return task
+
+    def rss(self):
+        # resident set size in bytes, where /proc is available
+        try:
+            with open('/proc/{0}/statm'.format(self.process.pid)) as statm:
+                pages = int(statm.read().split()[1])
+        except (OSError, ValueError, IndexError):
+            return 0
+        return pages * os.sysconf('SC_PAGE_SIZE')
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class Supervisor(object):
+
+    '''Pool of workers that are killed and replaced when they exceed limits'''
+
+    def __init__(self, target, jobs, timeout=None, max_rss=None, tick=0.5):
+        self.target = target
+        self.jobs = max(1, jobs)
+        self.timeout = timeout
+        self.max_rss = max_rss
+        self.tick = tick
+
+
+    #=================================================================
+    # Run all tasks, yielding (task, result, reason) as each finishes;
+    # reason is None on success, otherwise why the task was abandoned
+    #=================================================================
+    def run(self, tasks):
+        pending = deque(tasks)
+        workers = [Worker(self.target, self.max_rss)
+                   for n in range(self.jobs)]
+
+        try:
+            while True:
+                # hand out tasks to idle workers
+                for worker in workers:
+                    if worker.task is None and pending:
+                        worker.assign(pending.popleft())
+                busy = [w for w in workers if w.task is not None]
+                if not busy:
+                    break
+
+                # collect results, replacing workers that died mid-task
+                ready = wait([w.conn for w in busy], timeout=self.tick)
+                for n, worker in enumerate(workers):
+                    if worker.conn not in ready:
+                        continue
+                    try:
+                        reason, result = worker.conn.recv()
+                        yield worker.finish(), result, reason
+                    except (EOFError, OSError):
+                        worker.process.join(1)
+                        code = worker.process.exitcode
+                        task = worker.finish()
+                        workers[n] = self.replace(worker)
+                        yield task, None, 'worker exited ({0})'.format(code)
+
+                # kill workers that are stuck or using too much memory;
+                # the address-space cap set in each worker does the same
+                # between polls, or where /proc is not available
+                now = time.monotonic()
+                for n, worker in enumerate(workers):
+                    reason = None
+                    if worker.task is not None and self.timeout and \
+                            now - worker.started > self.timeout:
+                        reason = 'timed out after {0}s'.format(self.timeout)
+                    elif self.max_rss and worker.rss() > self.max_rss:
+                        reason = 'exceeded {0} bytes of memory'.format(
+                            self.max_rss)
+                    if reason is None:
+                        continue
+                    task = worker.finish()
+                    workers[n] = self.replace(worker)
+                    if task is not None:
+                        yield task, None, reason
+        finally:
+            for worker in workers:
+                worker.stop()
+
+
+    #=========================================
+    # Kill a worker and start a fresh one
+    #=========================================
+    def replace(self, worker):
+        worker.kill()
+        return Worker(self.target, self.max_rss)
@@ -0,0 +1,22 @@
+from classes.query import Query
+
+
+def test_required_tag_for_element_paths():
+    assert Query.required_tag('//dao') == b'<dao'
+    assert Query.required_tag('//dao[not(../unittitle)]') == b'<dao'
+    assert Query.required_tag('//c02/@id') == b'<c02'
+    assert Query.required_tag('//unittitle/text()') == b'<unittitle'
+    assert Query.required_tag('/ead/archdesc') == b'<ead'
+
+
+def test_no_required_tag_for_node_tests_and_axes():
+    for expression in ['//text()', '//comment()', '//node()',
+                       '//descendant::dao', '/child::ead', '//*', '//@id',
+                       '//ead:dao', '//text ()']:
+        assert Query.required_tag(expression) is None, expression
+
+
+def test_no_required_tag_for_non_path_expressions():
+    for expression in ['//dao or //c02', "//dao = ''", 'not(//dao)',
+                       'count(//dao)', '//dao | //c02']:
+        assert Query.required_tag(expression) is None, expression
@@ -2,21 +2,50 @@
 # -*- coding: utf8 -*-
 
 import argparse
-import codecs
+from collections import Counter
+from contextlib import redirect_stdout
+from copy import deepcopy
 import csv
-from io import BytesIO
+import hashlib
+from io import BytesIO, StringIO
 import json
 import logging
 import lxml.etree as ET
+import multiprocessing
 import os
 import re
+import resource
 import sys
+import time
 import xml.parsers.expat as xerr
 
+from classes.diff import TreeDiff as TreeDiff
 from classes.ead import Ead as Ead
+from classes.estimate import Estimate as Estimate
+from classes.query import Query as Query
+from classes.supervisor import Supervisor as Supervisor
 
 encodings = ['ascii', 'utf-8', 'windows-1252', 'latin-1']
 
+fixes = [
+    # add missing elements
+    'add_missing_extents',
+    'correct_text_in_extents',
+    'add_missing_box_containers',
+    'insert_handle',
+    'add_title_to_dao',
+
+    # remove duplicate, empty, and unneeded elements
+    'remove_multiple_abstracts',
+    'remove_empty_elements',
+    'remove_opening_of_title',
+
+    # fix errors and rearrange
+    'fix_box_number_discrepancies',
+    'move_scopecontent',
+    'sort_containers',
+    ]
+
 
 #========================================
 # Get list of EAD files (input or output)
@@ -42,17 +71,27 @@ def get_files_in_path(rootdir, recursive):
 #====================================================
 # Verify file decoding and return utf8-encoded bytes
 #====================================================
-def verify_decoding(f, encodings):
-    print("  Checking encoding...")
+def verify_decoding(f, encodings, verbose=True):
+    with open(f, 'rb') as infile:
+        return decode_bytes(infile.read(), encodings, verbose)
+
+
+#==================================================
+# Strictly decode raw bytes and re-encode as utf8
+#==================================================
+def decode_bytes(raw_bytes, encodings, verbose=True):
+    if verbose:
+        print("  Checking encoding...")
 
     for encoding in encodings:
-        bytes = codecs.open(f, mode='r', encoding=encoding, errors='strict')
         try:
-            b = bytes.read()
-            print('    - {0} OK.'.format(encoding))
+            b = raw_bytes.decode(encoding, errors='strict')
+            if verbose:
+                print('    - {0} OK.'.format(encoding))
             return b.encode('utf8')
         except UnicodeDecodeError:
-            print('    - {0} Error!'.format(encoding))
+            if verbose:
+                print('    - {0} Error!'.format(encoding))
 
     return False
 
@@ -71,6 +110,187 @@ def load_handles(handle_file):
     return result
 
 
+#=============================================
+# Set up the compiled queries in each worker
+#=============================================
+query = None
+
+def init_query_worker(expressions):
+    global query
+    query = Query(expressions)
+
+
+#================================================
+# Evaluate the queries against one file (worker)
+#================================================
+def query_file(f):
+    with open(f, 'rb') as infile:
+        raw_bytes = infile.read()
+
+    # skip files whose bytes cannot contain any of the queried elements
+    indexes = query.candidates(raw_bytes)
+    if not indexes:
+        return f, []
+
+    ead_bytes = decode_bytes(raw_bytes, encodings, verbose=False)
+    if not ead_bytes:
+        return f, None
+    try:
+        tree = ET.parse(BytesIO(ead_bytes))
+    except ET.XMLSyntaxError:
+        return f, None
+
+    return f, list(query.evaluate(f, tree, indexes))
+
+
+#==========================================================
+# Run the queries over all files in parallel, writing JSONL
+#==========================================================
+def run_queries(files, expressions, output_path, jobs):
+    # compile once up front so that bad expressions fail before forking
+    Query(expressions)
+    total = 0
+
+    with open(output_path, 'w') as outfile, multiprocessing.Pool(
+            jobs, initializer=init_query_worker,
+            initargs=(expressions,)) as pool:
+        for f, matches in pool.imap_unordered(query_file, files, 
+                                              chunksize=8):
+            if matches is None:
+                print("  Could not decode or parse {0}, skipping...".format(f))
+                logging.error("{0} could not be queried.".format(f))
+                continue
+            for match in matches:
+                outfile.write(json.dumps(match) + "\n")
+            outfile.flush()
+            total += len(matches)
+
+    print("Wrote {0} matches to {1}".format(total, output_path))
+
+
+#==================================================
+# Quiet the transformation log in estimate workers
+#==================================================
+def init_estimate_worker():
+    logger = logging.getLogger("transform.transform")
+    logger.propagate = False
+    logger.addHandler(logging.NullHandler())
+
+
+#=========================================================
+# Run the pipeline on one file in memory and measure it
+#=========================================================
+def estimate_file(task):
+    f, handle = task
+    measurement = {'bytes': os.path.getsize(f), 'seconds': 0.0, 
+                   'baseline': resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss,
+                   'rss': 0, 'failed': False, 'reason': None, 'changed': {}}
+    
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        # time the run as the real one would do it, up to any failure
+        start = time.perf_counter()
+        try:
+            ead_bytes = verify_decoding(f, encodings, verbose=False)
+            if not ead_bytes:
+                raise ValueError('could not be decoded')
+            ead = Ead(os.path.basename(f), handle, BytesIO(ead_bytes))
+            for fix in fixes:
+                getattr(ead, fix)()
+            ead.report_containers()
+            ead.tree.write(BytesIO(), pretty_print=True, encoding='utf-8', 
+                           xml_declaration=True)
+        except Exception as e:
+            measurement['failed'] = True
+            measurement['reason'] = '{0}: {1}'.format(type(e).__name__, e)
+        measurement['seconds'] = time.perf_counter() - start
+        measurement['rss'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss - measurement['baseline']
+        if measurement['failed']:
+            return f, measurement
+        
+        # after reading the memory, rerun to note what each fix changes
+        ead = Ead(os.path.basename(f), handle, BytesIO(ead_bytes))
+        for fix in fixes:
+            before = hashlib.md5(ET.tostring(ead.root)).digest()
+            getattr(ead, fix)()
+            after = hashlib.md5(ET.tostring(ead.root)).digest()
+            measurement['changed'][fix] = int(after != before)
+    
+    return f, measurement
+
+
+#=========================================================
+# Estimate runtime, memory and changes from a random sample
+#=========================================================
+def run_estimate(files, sample_size, jobs, handles):
+    estimate = Estimate(files, sample_size)
+    sample = [(f, handles.get(os.path.basename(f), ''))
+              for f in estimate.files()]
+    print("Running pipeline on a sample of {0} files...".format(len(sample)))
+    
+    # a fresh process per file keeps the peak RSS of each file separate
+    with multiprocessing.Pool(jobs, initializer=init_estimate_worker, 
+                              maxtasksperchild=1) as pool:
+        for f, measurement in pool.imap_unordered(estimate_file, sample):
+            estimate.add(f, measurement)
+    
+    print("\n".join([''] + estimate.report(fixes, jobs)))
+
+
+#===============================================
+# Transform one file and write the result (worker)
+#===============================================
+def transform_file(f, output_path, handle, diff=False, max_depth=None):
+    # collect the screen output so it can be printed with the file name
+    messages = StringIO()
+    with redirect_stdout(messages):
+        # attempt strict decoding of file according to common schemes
+        ead_bytes = verify_decoding(f, encodings, verbose=False)
+        if not ead_bytes:
+            raise ValueError('could not be decoded')
+        
+        # create an EAD object
+        ead = Ead(os.path.basename(f), handle, BytesIO(ead_bytes))
+        depth = ead.depth()
+        if max_depth and depth > max_depth:
+            raise ValueError('tree depth {0} exceeds {1}'.format(
+                depth, max_depth))
+        if diff is True:
+            original = deepcopy(ead.root)
+        
+        # apply the fixes in order
+        for fix in fixes:
+            getattr(ead, fix)()
+        ead.report_containers()
+    
+    # compare the transformed tree with the input tree
+    result = {'messages': messages.getvalue()}
+    if diff is True:
+        tree_diff = TreeDiff(original, ead.root)
+        result['changes'] = tree_diff.changes
+        result['summary'] = tree_diff.summary()
+    
+    # write out result to a temporary file, so a killed worker leaves no
+    # partial output behind for --resume to mistake for a finished file
+    temp_path = partial_path(output_path)
+    ead.tree.write(temp_path, 
+                   pretty_print=True, 
+                   encoding='utf-8', 
+                   xml_declaration=True
+                   )
+    os.replace(temp_path, output_path)
+    return result
+
+
+#=====================================================
+# Hidden temporary path used while writing an output
+#=====================================================
+def partial_path(output_path):
+    parent_dir, basename = os.path.split(output_path)
+    return os.path.join(parent_dir, '.{0}.partial'.format(basename))
+
+
 #===============================================================
 # Main function: Parse command line arguments and run main loop
 #===============================================================
@@ -99,12 +319,31 @@ def main():
     # Parse command line arguments
     #-----------------------------
     parser = argparse.ArgumentParser(description='Process and validate EAD.')
+    parser.add_argument('-d', '--diff', action='store_true',
+        help='report element-level changes made to each file')
     parser.add_argument('-e', '--encoding', action='store_true',
         help='check encoding only of files in input path')
     parser.add_argument('-i', '--input', 
         help='input path of files to be transformed')
     parser.add_argument('-o', '--output', required=True,
-        help='ouput path for transformed files')
+        help='ouput path for transformed files (or JSONL file for queries)')
+    parser.add_argument('-q', '--query', action='append',
+        help='XPath expression to evaluate over input files (repeatable)')
+    parser.add_argument('-j', '--jobs', type=int, 
+        default=multiprocessing.cpu_count(),
+        help='number of worker processes')
+    parser.add_argument('--max-bytes', type=int,
+        help='quarantine input files larger than this many bytes')
+    parser.add_argument('--max-depth', type=int,
+        help='quarantine files whose element tree is deeper than this')
+    parser.add_argument('--max-rss', type=int,
+        help='cap worker memory growth at this many MB, replacing workers '
+             'that exceed it')
+    parser.add_argument('--timeout', type=float,
+        help='quarantine files taking longer than this many seconds')
+    parser.add_argument('--estimate', type=int, nargs='?', const=100, 
+        metavar='N',
+        help='estimate a full run from a sample of about N files')
     parser.add_argument('-r', '--resume', action='store_true', 
         help='resume job, skipping files that already exist in outpath')
     parser.add_argument('-R', '--recursive', action='store_true', 
@@ -116,6 +355,8 @@ def main():
     parser.add_argument('files', nargs='*', 
         help='files to check')
     args = parser.parse_args()
+    if args.estimate is not None and args.estimate < 1:
+        parser.error('--estimate needs a sample size of at least 1')
     
     # notify that resume flag is set
     if args.resume is True:
@@ -151,6 +392,32 @@ def main():
     # set path for output
     output_dir = args.output
     
+    # run queries instead of transforming the files
+    if args.query:
+        print("Query flag (-q) is set, evaluating {0} expressions...".format(
+            len(args.query)))
+        run_queries(files_to_check, args.query, args.output, args.jobs)
+        return
+    
+    # estimate the run from a sample instead of transforming the files
+    if args.estimate is not None:
+        print("Estimate flag is set, sampling {0} files...".format(
+            args.estimate))
+        run_estimate(files_to_check, args.estimate, args.jobs, handles)
+        return
+    
+    
+    # set up the per-file change list and corpus rollups
+    if args.diff is True:
+        print("Diff flag (-d) is set, reporting changes to each file ...")
+        changes_file = open('data/reports/changes.jsonl', 'w')
+        change_counts = Counter()
+        changed_files = Counter()
+    
+    # files that exceeded a limit or failed, with the reason
+    quarantine = []
+    tasks = []
+    
     
     #---------------------------------------
     # Main loop  for processing each EAD XML
@@ -163,11 +430,6 @@ def main():
         parent_dir = os.path.dirname(output_path)
         if not os.path.isdir(parent_dir):
             os.makedirs(parent_dir)
-            
-        # summarize file paths to screen
-        print("\n{0}. Processing EAD file: {1}".format(n+1, f))
-        print("  IN  => {0}".format(f))
-        print("  OUT => {0}".format(output_path))
         
         # if the resume flag is set, skip files for which output file exists
         if args.resume:
@@ -175,6 +437,27 @@ def main():
                 print("  Skipping {0}: output file exists".format(f))
                 continue
         
+        # quarantine files too large to read safely
+        if args.max_bytes and os.path.getsize(f) > args.max_bytes:
+            quarantine.append((f, 'larger than {0} bytes'.format(
+                args.max_bytes)))
+            continue
+        
+        # queue files for transformation by the supervised workers
+        if args.encoding is not True:
+            if basename in handles.keys():
+                handle = handles[basename]
+            else:
+                missing_handles.append(basename)
+                handle = ''
+            tasks.append((f, output_path, handle, args.diff, args.max_depth))
+            continue
+        
+        # summarize file paths to screen
+        print("\n{0}. Processing EAD file: {1}".format(n+1, f))
+        print("  IN  => {0}".format(f))
+        print("  OUT => {0}".format(output_path))
+        
         # attempt strict decoding of file according to common schemes
         ead_bytes = verify_decoding(f, encodings)
         
@@ -182,60 +465,79 @@ def main():
             print("  Could not reliably decode {0}, skipping...".format(f))
             logging.error("{0} could not be decoded.".format(f))
             continue
-            
-        if args.encoding is True:
-            # validate XML and write to file
-            if args.validate is True:
-                file_like_obj = BytesIO(ead_bytes)
-                try:
-                    ead_tree = ET.parse(file_like_obj)
-                    # ead_schema.assertValid(ead_tree)
-                    ead_tree.write(output_path)
-                except:
-                    # logging.error(xmlschema.error_log.last_error)
-                    print("  Could not parse XML in {0}, skipping...".format(f))
-                    logging.error("{0} is malformed XML.".format(f))
-                    
-            # write decoded bytes to file without validation
-            else:
-                with open(output_path, 'wb') as outfile:
-                    outfile.write(ead_bytes)
-            continue
         
+        # validate XML and write to file
+        if args.validate is True:
+            file_like_obj = BytesIO(ead_bytes)
+            try:
+                ead_tree = ET.parse(file_like_obj)
+                # ead_schema.assertValid(ead_tree)
+                ead_tree.write(output_path)
+            except:
+                # logging.error(xmlschema.error_log.last_error)
+                print("  Could not parse XML in {0}, skipping...".format(f))
+                logging.error("{0} is malformed XML.".format(f))
+                
+        # write decoded bytes to file without validation
         else:
-            if basename in handles.keys():
-                handle = handles[basename]
-            else:
-                missing_handles.append(basename)
-                handle = ''
-            
-            # create an EAD object
-            print("  Parsing XML...")
-            ead = Ead(basename, handle, BytesIO(ead_bytes))
-            
-            # add missing elements
-            ead.add_missing_extents()
-            ead.correct_text_in_extents()
-            ead.add_missing_box_containers()
-            ead.insert_handle()
-            ead.add_title_to_dao()
+            with open(output_path, 'wb') as outfile:
+                outfile.write(ead_bytes)
+    
+    
+    #-------------------------------------------------
+    # Transform the queued files under the supervisor
+    #-------------------------------------------------
+    supervisor = Supervisor(transform_file, args.jobs, 
+                            timeout=args.timeout,
+                            max_rss=args.max_rss and args.max_rss * 1024 ** 2)
+    results = supervisor.run(tasks) if tasks else []
+    transformed = 0
+    
+    for task, result, reason in results:
+        f, output_path = task[:2]
+        if reason is not None:
+            quarantine.append((f, reason))
+            # clear any output left half-written by a killed worker
+            if os.path.exists(partial_path(output_path)):
+                os.remove(partial_path(output_path))
+            continue
+        
+        # summarize file paths and messages to screen
+        transformed += 1
+        print("\n{0}. Transformed EAD file: {1}".format(transformed, f))
+        print("  IN  => {0}".format(f))
+        print("  OUT => {0}".format(output_path))
+        if result['messages']:
+            print(result['messages'], end='')
+        
+        # record the changes to the file
+        if args.diff is True:
+            change_counts.update(result['summary'])
+            changed_files.update(result['summary'].keys())
+            changes_file.write(json.dumps(
+                {'file': f, 'changes': result['changes']}) + "\n")
+            print("  Recorded {0} changes".format(len(result['changes'])))
             
-            # remove duplicate, empty, and unneeded elements
-            ead.remove_multiple_abstracts()
-            ead.remove_empty_elements()
-            ead.remove_opening_of_title()
-
-            # fix errors and rearrange
-            ead.fix_box_number_discrepancies()
-            ead.move_scopecontent()
-            ead.sort_containers()
-
-            # write out result
-            ead.tree.write(output_path, 
-                           pretty_print=True, 
-                           encoding='utf-8', 
-                           xml_declaration=True
-                           )
+    # write out the corpus rollup of changes
+    if args.diff is True:
+        changes_file.close()
+        with open('data/reports/changes_summary.csv', 'w') as summaryfile:
+            writer = csv.writer(summaryfile)
+            writer.writerow(['change', 'element', 'count', 'files'])
+            for (change, tag), count in sorted(change_counts.items()):
+                writer.writerow([change, tag, count, 
+                                 changed_files[(change, tag)]])
+    
+    # write out the quarantined files
+    if quarantine:
+        print("\nQuarantined {0} files:".format(len(quarantine)))
+        with open('data/reports/quarantine.csv', 'w') as quarantinefile:
+            writer = csv.writer(quarantinefile)
+            writer.writerow(['file', 'reason'])
+            for f, reason in quarantine:
+                print("  {0}: {1}".format(f, reason))
+                logging.error("{0} was quarantined: {1}".format(f, reason))
+                writer.writerow([f, reason])
             
 
     # print(missing_handles)